@@ -5,12 +5,56 @@ As a bonus the images should also load faster in your favorite CBZ reader"""
 
 import os
 import sys
+import stat
 import io
 import glob
+import tempfile
+import mmap
+import struct
 import argparse
 import configparser
 import zipfile
-from PIL import Image
+import queue
+import threading
+import multiprocessing
+import functools
+import itertools
+import concurrent.futures
+from PIL import Image, features
+
+# numpy is optional, it is only needed for resampler = numba or gpu.
+# numba (and torch) are imported when they are used, see numbaKernel
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# PyTurboJPEG is optional, it decodes JPEG scaled by any factor of M/8
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY
+except ImportError:
+    TurboJPEG = None
+# TurboJPEG instance of a worker process, created by initWorker
+turboJpeg = None
+# True in the one worker process that may use the GPU, set by initWorker.
+# Every process that uses CUDA holds a context of a few hundred MB of GPU
+# memory, so the other workers resize with Pillow
+gpuWorker = False
+
+# os.umask can only be read by setting it, do it once at import while
+# there is a single thread, the CBZs are later resized in threads
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Extensions (without period, lower case) of the members that are resized
+IMAGE_EXTENSIONS = frozenset(("jpg", "jpeg", "png", "gif", "webp"))
+
+class MappedFile(mmap.mmap):
+    """Memory mapped file that zipfile can read from"""
+
+    def seekable(self):
+        """zipfile needs seekable(), mmap only has it from Python 3.13"""
+        return True
 
 def appendToErrorLog(text):
     """Append text to error log file"""
@@ -28,10 +72,348 @@ def appendToErrorLog(text):
         output.write(text)
         output.write('\n')
 
-def resize(inputZip, outputZip, resizeLandscape, resizePortrait, rotateLandscape):
-    """Resize images inside inputZip and save the new images into outputZip"""
+def initWorker(gpuSlots):
+    """Initialize a worker process of the image resizing pool. gpuSlots is
+    a shared counter of the workers that may still claim the GPU"""
+    global turboJpeg, gpuWorker
+    with gpuSlots.get_lock():
+        if gpuSlots.value > 0:
+            gpuSlots.value -= 1
+            gpuWorker = True
+    # Turn off "DecompressionBombWarning:
+    # Image size (xxxxpixels) exceeds limit..."
+    Image.MAX_IMAGE_PIXELS = None
+    if TurboJPEG:
+        try:
+            turboJpeg = TurboJPEG()
+        except (OSError, RuntimeError):
+            # PyTurboJPEG is installed but the libturbojpeg library is not
+            turboJpeg = None
+
+@functools.lru_cache(maxsize=16)
+def lanczosTaps(srcLength, dstLength):
+    """Return the first source pixel and the LANCZOS weights of every
+    destination pixel when resizing srcLength pixels to dstLength pixels.
+    Every page of a CBZ usually has the same size, so the taps are cached"""
+    # Same filter as Pillow, see ImagingResample in libImaging/Resample.c
+    scale = srcLength / dstLength
+    filterScale = max(scale, 1.0)
+    support = 3.0 * filterScale
+    size = min(int(numpy.ceil(support)) * 2 + 1, srcLength)
+    center = (numpy.arange(dstLength) + 0.5) * scale
+    first = numpy.clip((center - support + 0.5).astype(numpy.int64),
+                       0, srcLength)
+    last = numpy.clip((center + support + 0.5).astype(numpy.int64),
+                      0, srcLength)
+    # Keep all size taps inside the source, weights outside the
+    # filter window of a pixel are zero
+    starts = numpy.minimum(first, srcLength - size)
+    pixel = starts[:, numpy.newaxis] + numpy.arange(size)
+    x = (pixel - center[:, numpy.newaxis] + 0.5) / filterScale
+    taps = numpy.sinc(x) * numpy.sinc(x / 3.0)
+    taps[(numpy.abs(x) >= 3.0) | (pixel < first[:, numpy.newaxis]) |
+         (pixel >= last[:, numpy.newaxis])] = 0.0
+    taps /= taps.sum(axis=1, keepdims=True)
+    return starts, taps.astype(numpy.float32)
+
+def lanczosApply(src, startsH, tapsH, startsV, tapsV):
+    """Resize the uint8 array src (height, width, channels) with the taps
+    from lanczosTaps, first horizontally and then vertically"""
+    height, _, channels = src.shape
+    width = startsH.shape[0]
+    newHeight = startsV.shape[0]
+    # LANCZOS overshoots at sharp edges. Round and clip the horizontal pass
+    # to 8 bits like Pillow does, so the overshoot is not amplified by the
+    # vertical pass
+    tmp = numpy.empty((height, width, channels), numpy.uint8)
+    for y in range(height):
+        for x in range(width):
+            start = startsH[x]
+            for c in range(channels):
+                total = numpy.float32(0.0)
+                for k in range(tapsH.shape[1]):
+                    total += tapsH[x, k] * src[y, start + k, c]
+                tmp[y, x, c] = min(max(int(total + 0.5), 0), 255)
+    out = numpy.empty((newHeight, width, channels), numpy.uint8)
+    for y in range(newHeight):
+        start = startsV[y]
+        for x in range(width):
+            for c in range(channels):
+                total = numpy.float32(0.0)
+                for k in range(tapsV.shape[1]):
+                    total += tapsV[y, k] * tmp[start + k, x, c]
+                out[y, x, c] = min(max(int(total + 0.5), 0), 255)
+    return out
+
+@functools.lru_cache(maxsize=None)
+def numbaKernel():
+    """Return lanczosApply compiled by numba if numba is installed, else
+    None. numba takes a while to import, so it is only imported for
+    resampler = numba"""
+    if numpy is None:
+        return None
+    try:
+        import numba
+    except ImportError:
+        return None
+    # Images are already spread over one worker process per core,
+    # so the kernel is not parallelized (prange) as well
+    return numba.njit(lanczosApply)
+
+@functools.lru_cache(maxsize=None)
+def gpuTorch():
+    """Return the torch module if PyTorch is installed and has a CUDA
+    device, else None. torch takes seconds to import, so it is only
+    imported for resampler = gpu"""
+    if numpy is None:
+        return None
+    try:
+        import torch
+    except ImportError:
+        return None
+    return torch if torch.cuda.is_available() else None
+
+@functools.lru_cache(maxsize=4)
+def lanczosMatrix(srcLength, dstLength):
+    """Return the LANCZOS taps of lanczosTaps as a dense (dstLength,
+    srcLength) float16 matrix on the GPU, every row is a narrow band.
+    A matrix can take tens of MB of GPU memory, so only the vertical and
+    horizontal matrices of the last two page sizes are cached"""
+    torch = gpuTorch()
+    starts, taps = lanczosTaps(srcLength, dstLength)
+    matrix = numpy.zeros((dstLength, srcLength), numpy.float32)
+    rows = numpy.arange(dstLength)[:, numpy.newaxis]
+    matrix[rows, starts[:, numpy.newaxis] + numpy.arange(taps.shape[1])] = taps
+    return torch.from_numpy(matrix).to('cuda', torch.float16)
+
+def gpuLanczos(src, size):
+    """Resize the uint8 array src (height, width, channels) to size with
+    LANCZOS on the GPU, as a horizontal and a vertical matrix product"""
+    torch = gpuTorch()
+    height, width, _ = src.shape
+    weightsV = lanczosMatrix(height, size[1])
+    weightsH = lanczosMatrix(width, size[0])
+    # Copy the 8 bit pixels to the GPU and convert them there.
+    # float16 halves the memory traffic and runs on the tensor cores
+    pixels = torch.tensor(src).to('cuda').permute(2, 0, 1).to(torch.float16)
+    # Same order as Pillow and lanczosApply: the horizontal pass first,
+    # rounded and clipped to 8 bits, so the LANCZOS overshoot is not
+    # amplified by the vertical pass
+    out = weightsV @ (pixels @ weightsH.T).round_().clamp_(0, 255)
+    out = out.round_().clamp_(0, 255).to(torch.uint8).permute(1, 2, 0)
+    return out.contiguous().cpu().numpy()
+
+def lanczosResize(img, target, resampler, reducingGap):
+    """Shrink img to fit inside target with LANCZOS, keeping the aspect
+    ratio like Image.thumbnail. Returns img itself if it already fits.
+    resampler is 'pillow', 'numba' or 'gpu', reducingGap is None or at
+    least 1"""
+    scale = min(target[0] / img.size[0], target[1] / img.size[1])
+    if scale >= 1:
+        return img
+    size = (max(round(img.size[0] * scale), 1),
+            max(round(img.size[1] * scale), 1))
+    # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.resize
+    # With reducing_gap, resize() first shrinks the image by an integer
+    # factor with reduce(), a cheap box filter, but keeps it at least
+    # reducing_gap times the new size. LANCZOS then only has to do the
+    # fractional remainder, on far fewer pixels.
+    if (img.mode in ('RGB', 'L') and
+            (resampler == 'numba' and numbaKernel() or
+             resampler == 'gpu' and gpuWorker and gpuTorch())):
+        if reducingGap:
+            factor = int(1 / scale / reducingGap)
+            if factor > 1:
+                img = img.reduce(factor)
+        src = numpy.asarray(img)
+        if img.mode == 'L':
+            src = src[:, :, numpy.newaxis]
+        if resampler == 'gpu':
+            out = gpuLanczos(src, size)
+        else:
+            startsH, tapsH = lanczosTaps(img.size[0], size[0])
+            startsV, tapsV = lanczosTaps(img.size[1], size[1])
+            out = numbaKernel()(src, startsH, tapsH, startsV, tapsV)
+        return Image.fromarray(out[:, :, 0] if img.mode == 'L' else out)
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=reducingGap)
+
+def peekImageSize(raw):
+    """Return the format and size of the JPEG or PNG image raw, read from
+    its header without decoding it. None for other formats"""
+    # https://www.w3.org/TR/png/#11IHDR
+    if (len(raw) >= 24 and raw.startswith(b'\x89PNG\r\n\x1a\n') and
+            raw[12:16] == b'IHDR'):
+        width, height = struct.unpack('>II', raw[16:24])
+        return 'PNG', (width, height)
+    # https://www.w3.org/Graphics/JPEG/itu-t81.pdf (B.1.1.3 and B.2.2)
+    # Walk the marker segments up to the SOFn (start of frame) marker.
+    # The loop stops when a segment runs past the end of raw, a broken
+    # image is then left to the decoder
+    if raw.startswith(b'\xff\xd8'):
+        pos = 2
+        while pos + 9 <= len(raw) and raw[pos] == 0xFF:
+            marker = raw[pos + 1]
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+            elif 0xD0 <= marker <= 0xD9 or marker == 0x01:
+                # Markers without a segment
+                pos += 2
+            elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                length, _, height, width = struct.unpack(
+                    '>HBHH', raw[pos + 2:pos + 9])
+                if length < 8 or pos + 2 + length > len(raw):
+                    # Broken or cut off frame header
+                    return None
+                # A height of 0 is defined later by a DNL marker
+                return ('JPEG', (width, height)) if height else None
+            else:
+                pos += 2 + struct.unpack('>H', raw[pos + 2:pos + 4])[0]
+    return None
+
+def turboDecode(raw, mode, size, target):
+    """Decode the JPEG raw of mode 'RGB' or 'L' and size with libjpeg-turbo.
+    The IDCT scales it down by the smallest factor that still leaves it at
+    least as big as it will be once it is fitted inside target"""
+    scale = min(target[0] / size[0], target[1] / size[1])
+    factor = min((f for f in turboJpeg.scaling_factors
+                  if scale <= f[0] / f[1] <= 1),
+                 key=lambda f: f[0] / f[1])
+    pixels = turboJpeg.decode(raw,
+                              pixel_format=TJPF_GRAY if mode == 'L' else TJPF_RGB,
+                              scaling_factor=factor if factor != (1, 1) else None)
+    return Image.fromarray(pixels[:, :, 0] if mode == 'L' else pixels)
+
+def resizeImage(raw, resizeLandscape, resizePortrait, angle, resampler,
+                reducingGap, reencodeHuffman):
+    """Resize the encoded image raw, runs in a worker process.
+    Returns the format, the new encoded image, the old size and the new size"""
+    # Decode from the member's bytes rather than from inputZip.open(), so
+    # that the decoder reads from memory instead of going through the zip
+    # decompressor with many small read() calls. The bytes are also written
+    # as is when the image needs no resizing
+    with Image.open(io.BytesIO(raw)) as img:
+        oldSize = img.size
+        landscape = img.size[0] > img.size[1]
+        # Image.open only reads the header, img keeps the format for
+        # saving while decoded holds the pixels
+        decoded = img
+        if img.format == 'JPEG':
+            # Landscape images are rotated before they are resized
+            if not landscape:
+                target = resizePortrait
+            elif angle in (90, 270):
+                target = (resizeLandscape[1], resizeLandscape[0])
+            else:
+                target = resizeLandscape
+            if reducingGap:
+                # Like reduce() in lanczosResize, scaling while decoding is
+                # a cheap filter, so the image is kept at least reducingGap
+                # times the target size and LANCZOS below still does the
+                # final resize. Without reducingGap LANCZOS gets the full
+                # image
+                target = (round(target[0] * reducingGap),
+                          round(target[1] * reducingGap))
+                if (turboJpeg and img.mode in ('RGB', 'L') and
+                        (img.size[0] > target[0] or img.size[1] > target[1])):
+                    # libjpeg-turbo can scale by 7/8, 3/4, 5/8 ... while
+                    # decoding, a much closer fit than the powers of two of
+                    # draft()
+                    decoded = turboDecode(raw, img.mode, img.size, target)
+                else:
+                    # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.draft
+                    # Let libjpeg scale the image by 1/2, 1/4 or 1/8 while
+                    # decoding, it skips most of the IDCT work
+                    img.draft(None, target)
+        # https://stackoverflow.com/questions/29367990/what-is-the-difference-between-image-resize-and-image-thumbnail-in-pillow-python
+        # Note: No shrinkage will occur unless ONE of the dimension is
+        #       bigger than 1080. Aspect ratio is always kept
+        #
+        # https://pillow.readthedocs.io/en/stable/handbook/concepts.html#concept-filters
+        #           Performance    Downscale Quality
+        # BOX       ****           *
+        # BILINEAR  ***            *
+        # HAMMING   ***            **
+        # BICUBIC   **             ***
+        # LANCZOS   *              ****
+        #
+        # ANTIALIAS is a alias for LANCZOS for backward compatibility
+        if landscape:
+            out = decoded.rotate(angle, expand=True, fillcolor=None)
+            out = lanczosResize(out, resizeLandscape, resampler, reducingGap)
+            # out.show()
+        else:
+            out = lanczosResize(decoded, resizePortrait, resampler, reducingGap)
+        if out.size == oldSize:
+            # Neither resized nor rotated (rotating a landscape image swaps
+            # its width and height), keep the original to save the encoding
+            return img.format, raw, oldSize, out.size
+        # Free the full size image before encoding, so that a worker holds
+        # at most the resized image and its encoding. img keeps its format
+        # after it is closed
+        decoded = None
+        if out is not img:
+            img.close()
+        # A new BytesIO per image, getvalue() then returns its buffer
+        # without copying it (a reused buffer would have to be copied)
+        buffer = io.BytesIO()
+        if reencodeHuffman and img.format == 'JPEG':
+            # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#jpeg-saving
+            # Same quality as below, only the entropy coding changes:
+            # optimized Huffman tables and a progressive scan make the
+            # file a few percent smaller without losing anything
+            out.save(buffer, format='JPEG', optimize=True, progressive=True)
+        else:
+            out.save(buffer, format=img.format)
+        return img.format, buffer.getvalue(), oldSize, out.size
+
+def outputInfo(info):
+    """Return a new ZipInfo for the output zip with the name, timestamp,
+    attributes, comment and extra field of the input member info"""
+    # Don't hand the input's ZipInfo to writestr, it overwrites the sizes,
+    # CRC and offset in it with those of the output entry
+    zinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    # external_attr means different things on different systems (Unix
+    # mode bits or MS-DOS attributes), it is only valid with create_system
+    zinfo.create_system = info.create_system
+    zinfo.external_attr = info.external_attr
+    zinfo.comment = info.comment
+    # https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT (4.5)
+    # Drop the ZIP64 record (header ID 1) of the extra field, its sizes are
+    # those of the input. zipfile adds a new one when the output needs it
+    extra = []
+    pos = 0
+    while pos + 4 <= len(info.extra):
+        headerId, length = struct.unpack('<HH', info.extra[pos:pos + 4])
+        if headerId != 1:
+            extra.append(info.extra[pos:pos + 4 + length])
+        pos += 4 + length
+    zinfo.extra = b''.join(extra)
+    return zinfo
+
+def readMembers(inputZip, infoList, members, stop):
+    """Read the members in infoList from inputZip into the queue members,
+    runs in its own thread. Puts None when done or the exception on error"""
+    try:
+        for info in infoList:
+            if stop.is_set():
+                return
+            # Pass the ZipInfo, not the name, saves looking it up again
+            members.put((info, inputZip.read(info)))
+    except BaseException as err:
+        members.put(err)
+        return
+    members.put(None)
+
+def resize(inputZip, outputZip, resizeLandscape, resizePortrait, rotateLandscape,
+           resampler, reducingGap, reencodeHuffman, executor, name):
+    """Resize images inside inputZip and save the new images into outputZip.
+    The images are resized in parallel by the worker processes of executor.
+    name prefixes the progress lines, other CBZs print theirs at the same time"""
+    # infolist() returns the list zipfile built from the central directory,
+    # it is not copied
     infoList = inputZip.infolist()
-    i = 1
+    progress = itertools.count(1)
     total = len(infoList)
 
     if rotateLandscape.lower() == 'left':
@@ -45,45 +427,101 @@ def resize(inputZip, outputZip, resizeLandscape, resizePortrait, rotateLandscape
     else:
         angle = 0
 
-    for info in infoList:
-        filename = info.filename
-        _, ext = os.path.splitext(filename)
-        if not ext.lower() in (".jpg", ".jpeg", ".png", ".gif", ".webp"):
-            outputZip.writestr(info, inputZip.read(filename))
-            continue
-
-        with Image.open(inputZip.open(filename)) as img:
-            # https://stackoverflow.com/questions/29367990/what-is-the-difference-between-image-resize-and-image-thumbnail-in-pillow-python
-            # Note: No shrinkage will occur unless ONE of the dimension is
-            #       bigger than 1080. Aspect ratio is always kept
-            #
-            # https://pillow.readthedocs.io/en/stable/handbook/concepts.html#concept-filters
-            #           Performance    Downscale Quality
-            # BOX       ****           *
-            # BILINEAR  ***            *
-            # HAMMING   ***            **
-            # BICUBIC   **             ***
-            # LANCZOS   *              ****
-            #
-            # ANTIALIAS is a alias for LANCZOS for backward compatibility
-            if img.size[0] > img.size[1]:
-                out = img.rotate(angle, expand=True, fillcolor=None)
-                out.thumbnail(resizeLandscape, Image.Resampling.LANCZOS)
-                # out.show()
-            else:
-                out = img
-                out.thumbnail(resizePortrait, Image.Resampling.LANCZOS)
-            print(f"{i}/{total} {img.format} {img.size}->{out.size} {filename}")
-            i = i + 1
-            buffer = io.BytesIO()
-            out.save(buffer, format=img.format)
-            outputZip.writestr(info, buffer.getvalue())
-            sys.stdout.flush()
-            # output.getvalue()
-            # img.show()
-
-
-def resizeZippedImages(inputPath, outputPath, configParameters):
+    # Only keep a few images per worker in flight, so that a huge CBZ
+    # is not read into memory all at once
+    maxPending = 2 * (os.cpu_count() or 1)
+    pending = {}
+    write = outputZip.writestr
+    submit = executor.submit
+
+    def writeFinished(futures):
+        """Write the images of the finished futures into outputZip"""
+        for future in futures:
+            info = pending.pop(future)
+            fmt, data, oldSize, newSize = future.result()
+            i = next(progress)
+            # Flushing every line is slow for CBZs with thousands of
+            # small images, flush every 16 lines and at the end
+            print(f"{name}: {i}/{total} {fmt} {oldSize}->{newSize} "
+                  f"{info.filename}",
+                  flush=i % 16 == 0)
+            # The order of the entries does not matter,
+            # CBZ readers sort the pages by name.
+            # Images are stored, JPEG, PNG, GIF and WebP are already
+            # compressed and deflating them again gains next to nothing
+            write(outputInfo(info), data, compress_type=zipfile.ZIP_STORED)
+
+    # Read (and decompress) the members in a separate thread, so that the
+    # reading overlaps with writing the output zip in this thread.
+    # zipfile releases the GIL while it inflates and does I/O
+    members = queue.Queue(maxsize=4)
+    stop = threading.Event()
+    reader = threading.Thread(target=readMembers,
+                              args=(inputZip, infoList, members, stop),
+                              daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = members.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            info, raw = item
+            _, period, ext = info.filename.rpartition('.')
+            if info.is_dir() or not raw:
+                # Nothing to compress, a deflated empty member is bigger
+                write(outputInfo(info), raw, compress_type=zipfile.ZIP_STORED)
+                continue
+            if not period or ext.lower() not in IMAGE_EXTENSIONS:
+                # Metadata such as ComicInfo.xml is text that deflates
+                # well, level 1 is plenty for these small members
+                write(outputInfo(info), raw,
+                      compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+                continue
+
+            # Copy images that are small enough right away, without even
+            # sending them to a worker. Landscape images still have to be
+            # rotated when rotation is on
+            peek = peekImageSize(raw)
+            if peek:
+                fmt, size = peek
+                landscape = size[0] > size[1]
+                target = resizeLandscape if landscape else resizePortrait
+                if (size[0] <= target[0] and size[1] <= target[1] and
+                        not (landscape and angle)):
+                    i = next(progress)
+                    print(f"{name}: {i}/{total} {fmt} {size}->{size} "
+                          f"{info.filename}",
+                          flush=i % 16 == 0)
+                    write(outputInfo(info), raw,
+                          compress_type=zipfile.ZIP_STORED)
+                    continue
+
+            future = submit(resizeImage, raw, resizeLandscape, resizePortrait,
+                            angle, resampler, reducingGap, reencodeHuffman)
+            pending[future] = info
+            if len(pending) >= maxPending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                writeFinished(done)
+
+        writeFinished(concurrent.futures.as_completed(list(pending)))
+        sys.stdout.flush()
+    finally:
+        # Don't waste the workers on images of a failed CBZ
+        for future in pending:
+            future.cancel()
+        # Unblock the reader if it is waiting for room in the queue
+        stop.set()
+        while reader.is_alive():
+            try:
+                members.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def resizeZippedImages(inputPath, outputPath, configParameters, executor):
     """Resize images in file inputPath and save the new images in outputPath"""
     print(f"Resizing: {inputPath} -> {outputPath}")
     value = int(configParameters['resize_landscape'])
@@ -91,15 +529,52 @@ def resizeZippedImages(inputPath, outputPath, configParameters):
     value = int(configParameters['resize_portrait'])
     resizePortrait = (value, value)
     rotateLandscape = configParameters['rotate_landscape']
-    tempPath = outputPath + ".0bd15818604b995cd9c00825a4c692d5d.temp"
+    # Config files written by older versions don't have the newer parameters
+    resampler = configParameters.get('resampler', 'pillow').lower()
+    reducingGap = float(configParameters.get('reducing_gap', '2.0'))
+    if reducingGap < 1:
+        reducingGap = None
+    # https://docs.python.org/3/library/configparser.html#configparser.ConfigParser.getboolean
+    # Accepts 1/0, true/false, yes/no and on/off
+    reencodeHuffman = configParameters.getboolean('reencode_huffman',
+                                                  fallback=False)
+    # Only the temporary file of this job is ever removed, outputPath may
+    # be the finished output of another job
+    tempPath = None
     try:
-        directory, _ = os.path.split(outputPath)
-        if directory and not os.path.isdir(directory):
-            os.makedirs(directory)
-        with zipfile.ZipFile(inputPath) as inZip:
-            with zipfile.ZipFile(tempPath, 'w', zipfile.ZIP_STORED) as outZip:
-                resize(inZip, outZip, resizeLandscape, resizePortrait, rotateLandscape)
-            os.rename(tempPath, outputPath)
+        directory, outputName = os.path.split(outputPath)
+        if directory:
+            # One syscall when it exists, no separate isdir() check. Another
+            # CBZ resized at the same time may also create it
+            os.makedirs(directory, exist_ok=True)
+        # Map the CBZ into memory instead of reading it through a buffered
+        # file, the members are then read without a syscall each and the
+        # kernel pages them in sequentially. The map must outlive inZip
+        with open(inputPath, 'rb') as inFile, \
+             MappedFile(inFile.fileno(), 0, access=mmap.ACCESS_READ) as inMap, \
+             zipfile.ZipFile(inMap) as inZip:
+            # https://docs.python.org/3/library/tempfile.html#tempfile.mkstemp
+            # A unique temporary file per job, two jobs never write the same
+            # file even if they have the same outputPath
+            fd, tempPath = tempfile.mkstemp(prefix=outputName + '.',
+                                            suffix='.temp',
+                                            dir=directory or os.curdir)
+            # mkstemp creates the file readable by the owner only, give the
+            # output the permissions open() would have given it
+            os.chmod(tempPath, 0o666 & ~UMASK)
+            # Write through a large buffer, the output is written
+            # sequentially and fewer, bigger writes mean fewer syscalls
+            with os.fdopen(fd, 'wb', buffering=1 << 20) as outFile, \
+                 zipfile.ZipFile(outFile, 'w', zipfile.ZIP_STORED,
+                                 allowZip64=True) as outZip:
+                resize(inZip, outZip, resizeLandscape, resizePortrait,
+                       rotateLandscape, resampler, reducingGap,
+                       reencodeHuffman, executor, os.path.basename(inputPath))
+        # outZip has written the central directory and outFile is flushed
+        # and closed. os.replace is atomic and, unlike os.rename, also
+        # replaces an existing file on Windows
+        os.replace(tempPath, outputPath)
+        tempPath = None
     except ValueError as err:
         appendToErrorLog(f"{inputPath}: {err}")
     except BaseException as err:
@@ -110,18 +585,27 @@ def resizeZippedImages(inputPath, outputPath, configParameters):
         # An f-string such as f'{expr=}' will expand to the text of the expr,
         # an equal sign, then the representation of the evaluated expression
         appendToErrorLog(f"{inputPath}: Unexpected {err}, {type(err)}")
-        if os.path.exists(tempPath):
-            os.remove(tempPath)
-        if os.path.exists(outputPath):
-            os.remove(outputPath)
         raise
-
-def resizeCbz(path, configParameters):
-    """resize the CBZ path with configuration specified in configParameters"""
-    if not os.path.isfile(path):
+    finally:
+        if tempPath:
+            try:
+                os.remove(tempPath)
+            except FileNotFoundError:
+                pass
+
+def resizeCbz(path, configParameters, executor):
+    """resize the CBZ path with configuration specified in configParameters,
+    the images are resized by the worker processes of executor"""
+    # Comic libraries are often on network or FUSE file systems where every
+    # stat is a round trip, so stat each path only once
+    try:
+        isFile = stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        isFile = False
+    if not isFile:
         raise ValueError(f"{path} is not a file")
 
-    name, ext = os.path.splitext(path)
+    _, ext = os.path.splitext(path)
     if int(configParameters['ext_zip_or_cbz']) != 0:
         if ext.lower() not in (".cbz", ".zip"):
             # Just print a warning without calling appendToErrorLog,
@@ -130,6 +614,16 @@ def resizeCbz(path, configParameters):
             print(f"{path} does not have extension .cbz or .zip")
             return
 
+    outputPath = resizedPath(path, configParameters)
+    if os.path.exists(outputPath):
+        # Not an error, just give a warning
+        print(f"output {outputPath} already exists")
+    else:
+        resizeZippedImages(path, outputPath, configParameters, executor)
+
+def resizedPath(path, configParameters):
+    """Return the path of the resized CBZ of path"""
+    name, ext = os.path.splitext(path)
     resizedFileExt = configParameters['resized_file_ext']
     if not resizedFileExt.startswith('.'):
         resizedFileExt = '.' + resizedFileExt
@@ -145,12 +639,34 @@ def resizeCbz(path, configParameters):
     if outputDirectory:
         outputPath = os.path.join(outputDirectory,
                                   os.path.basename(outputPath))
-
-    if os.path.exists(outputPath):
-        # Not an error, just give a warning
-        print(f"output {outputPath} already exists")
-    else:
-        resizeZippedImages(path, outputPath, configParameters)
+    return outputPath
+
+def uniquePaths(paths, configParameters):
+    """Return paths without the paths that name the same CBZ, or the same
+    resized CBZ, as an earlier path. The CBZs are resized at the same time,
+    two jobs writing the same output would overwrite each other"""
+    inputs = set()
+    outputs = set()
+    unique = []
+    for path in paths:
+        try:
+            outputPath = os.path.normcase(os.path.realpath(
+                resizedPath(path, configParameters)))
+        except ValueError:
+            # resizeCbz reports it
+            outputPath = None
+        inputPath = os.path.normcase(os.path.realpath(path))
+        if inputPath in inputs:
+            print(f"{path} is given more than once, skipped")
+        elif outputPath in outputs:
+            appendToErrorLog(f"{path}: resized to the same file as " +
+                             "another CBZ, skipped")
+        else:
+            inputs.add(inputPath)
+            if outputPath:
+                outputs.add(outputPath)
+            unique.append(path)
+    return unique
 
 def readConfigurationFile(arg0):
     """Read configuration file from a series of possible directories"""
@@ -205,6 +721,22 @@ def readConfigurationFile(arg0):
         # By default, will only process files with extension ".zip" or ".cbz"
         configParameters['ext_zip_or_cbz'] = '1'
 
+        # LANCZOS implementation; PILLOW (fastest on the CPU), NUMBA (needs
+        # numpy and numba, about half as fast as PILLOW) or
+        # GPU (needs numpy and PyTorch with CUDA, for very large scans)
+        configParameters['resampler'] = 'pillow'
+        # Shrink by an integer factor with a cheap box filter before LANCZOS,
+        # as long as the image stays reducing_gap times the new size.
+        # Larger is better quality but slower, 0 turns it off
+        configParameters['reducing_gap'] = '2.0'
+
+        # Number of CBZ files resized at the same time (at most one per core)
+        configParameters['parallel_files'] = '4'
+
+        # Save resized JPEG images as progressive JPEG with optimized Huffman
+        # tables, smaller but some older readers can't show progressive JPEG
+        configParameters['reencode_huffman'] = '0'
+
         if os.name == 'nt':
             # For Windows, create sample in the app's directory
             parentDir = cmdDirectory
@@ -280,22 +812,63 @@ if __name__ == '__main__':
 
     def main(argv):
         """main(arg)"""
-        # Turn off "DecompressionBombWarning:
-        # Image size (xxxxpixels) exceeds limit..."
-        Image.MAX_IMAGE_PIXELS = None
+        # Decoding and encoding JPEG is most of the work, libjpeg-turbo
+        # does it several times faster than plain libjpeg
+        if not features.check_feature('libjpeg_turbo'):
+            print("Warning: Pillow is not built with libjpeg-turbo, " +
+                  "JPEG images will be processed slowly")
         arg0 = argv[0]
         configParameters = readConfigurationFile(arg0)
         configParameters, filename = parseArguments(argv, configParameters)
         for key in configParameters:
             print(f"{key}={configParameters[key]}")
+        resampler = configParameters.get('resampler', '').lower()
+        if resampler == 'numba' and not numbaKernel():
+            print("Warning: resampler = numba but numba is not installed, " +
+                  "using pillow")
+        if resampler == 'gpu' and not gpuTorch():
+            print("Warning: resampler = gpu but PyTorch with CUDA is not " +
+                  "available, using pillow")
+
+        def resizeCbzLogErrors(path, executor):
+            """resizeCbz(path) and log the errors caused by path"""
+            try:
+                resizeCbz(path, configParameters, executor)
+            except ValueError as err:
+                appendToErrorLog(f"{path}: {err}")
 
         if len(filename) > 0:
+            paths = []
             for x in filename[0:]:
-                for path in glob.glob(x) if '*' in x or '?' in x else [x]:
-                    try:
-                        resizeCbz(path, configParameters)
-                    except ValueError as err:
-                        appendToErrorLog(f"{path}: {err}")
+                paths.extend(glob.glob(x) if '*' in x or '?' in x else [x])
+            paths = uniquePaths(paths, configParameters)
+            # A few CBZs are resized at the same time, so that one CBZ
+            # reading or writing its zip doesn't leave the workers idle.
+            # They share the worker processes, so threads are enough
+            parallelFiles = int(configParameters.get('parallel_files', '4'))
+            parallelFiles = max(1, min(parallelFiles, os.cpu_count() or 1))
+            # One worker process per core, every image is independent.
+            # Spawn rather than fork the workers, forking a process that
+            # runs threads can copy locks held by the other threads
+            context = multiprocessing.get_context('spawn')
+            # Only one worker resizes on the GPU, see gpuWorker
+            gpuSlots = context.Value('i', 1)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=os.cpu_count(), mp_context=context,
+                    initializer=initWorker,
+                    initargs=(gpuSlots,)) as executor, \
+                 concurrent.futures.ThreadPoolExecutor(
+                    max_workers=parallelFiles) as files:
+                futures = [files.submit(resizeCbzLogErrors, path, executor)
+                           for path in paths]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # Stop at the first unexpected error, like before
+                    for future in futures:
+                        future.cancel()
+                    raise
         else:
             cmd = os.path.basename(arg0)
             print(f"\nUsage: {cmd} [file ...]\n" +
@@ -303,4 +876,5 @@ if __name__ == '__main__':
                     "Example: {cmd} collection/*.cbz xyz/??.cbz\n\n" +
                     "Run {cmd} --help for more information.")
 
-main(sys.argv)
\ No newline at end of file
+    # The guard is required, the worker processes import this file
+    main(sys.argv)